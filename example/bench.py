@@ -0,0 +1,202 @@
+#!/usr/bin/python3
+import os, sys, time, json, platform, tracemalloc, serial
+from struct import pack
+from pyPMX import PMXProtocol, B2Bs, W2Bs, L2Bs
+from pmx import pmx, pmxgroup
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+
+
+def crc16(data):
+  crc = 0
+  for d in data:
+    crc ^= d << 8
+    for _ in range(8):
+      crc = ((crc << 1) ^ 0x1021) & 0xffff if crc & 0x8000 else (crc << 1) & 0xffff
+  return crc
+
+
+# In-memory port that answers like a PMX (model PMX-SCR-9204HV), so only the Python side is measured.
+class FakePort(serial.Serial):
+
+  def __init__(self, baudrate=1000000):
+    super().__init__(None, baudrate=baudrate, timeout=0)
+    self._rx = bytearray()
+    self._mem = bytearray(0x500)
+    self._mem[300:306] = pack('<hhh', 1234, 56, 78)
+    self._replies = {}
+
+  def _reply(self, txp):
+    id, cmd, param = txp[2], txp[4], txp[6:-2]
+    if cmd == PMXProtocol.CMD_MemREAD:
+      addr = param[0] | (param[1] << 8)
+      d = bytes(self._mem[addr:addr + param[2]])
+    elif cmd == PMXProtocol.CMD_MemWRITE:
+      d = b''
+    elif cmd == PMXProtocol.CMD_MotorREAD or cmd == PMXProtocol.CMD_MotorWRITE:
+      d = bytes(self._mem[500:501]) + bytes(self._mem[300:306])
+    elif cmd == PMXProtocol.CMD_SystemREAD:
+      d = pack('<IIIB', 0x12345678, 0x2B6723F4, 0x01000000, 20)
+    else:
+      d = b''
+    r = bytes([0xfe, 0xfe, id, len(d) + 8, cmd - 0x80, 0]) + d
+    return r + pack('<H', crc16(r))
+
+  def load(self, data):
+    self._rx += data
+
+  def reset_input_buffer(self):
+    self._rx.clear()
+
+  def flushOutput(self):
+    pass
+
+  def flush(self):
+    pass
+
+  def close(self):
+    pass
+
+  @property
+  def in_waiting(self):
+    return len(self._rx)
+
+  def read(self, size=1):
+    r = bytes(self._rx[:size])
+    del self._rx[:size]
+    return r
+
+  def write(self, data):
+    data = bytes(data)
+    r = self._replies.get(data)
+    if r is None:
+      r = self._replies[data] = self._reply(data)
+    self._rx += r
+    return len(data)
+
+
+def measure(func, mintime=0.2, repeat=5):
+  n = 1
+  while True:
+    t = time.perf_counter_ns()
+    for _ in range(n):
+      func()
+    t = time.perf_counter_ns() - t
+    if t >= mintime * 1e9 / repeat:
+      break
+    n *= 4
+  best = t / n
+  for _ in range(repeat - 1):
+    t = time.perf_counter_ns()
+    for _ in range(n):
+      func()
+    best = min(best, (time.perf_counter_ns() - t) / n)
+  tracemalloc.start()
+  func()
+  tracemalloc.reset_peak()
+  base = tracemalloc.get_traced_memory()[0]
+  func()
+  peak = tracemalloc.get_traced_memory()[1] - base
+  tracemalloc.stop()
+  return best, peak
+
+
+def cases():
+  port = FakePort()
+  p = PMXProtocol(port)
+  crc = p._PMXProtocol__crc16
+  w120 = tuple(range(-60, 60))
+  l60 = tuple(range(-30, 30))
+  b16 = tuple(range(-8, 8))
+  frame16 = bytes(range(16))
+  frame248 = bytes(range(248))
+  memread_reply = port._reply(bytes([0xfe, 0xfe, 0, 11, PMXProtocol.CMD_MemREAD, 0, 44, 1, 6, 0, 0]))
+
+  def rxpacket():
+    port.load(memread_reply)
+    p.RxPacket()
+
+  m = pmx(p, 0)
+  m.updateitems({
+    'PresentValue': (300, 'hhh', 'r', (None, None), ('º', 'º/s', 'mA'), (1 / 100, 1 / 10, 1.0)),
+    'GoalPos': (700, 'h', 'rw', (-32000, 32000), 'º', 1 / 100),
+    'GoalPosSpd': (700, 'hh', 'rw', ((-32000, -3800), (32000, 3800)), ('º', 'º/s'), (1 / 100, 1 / 10)),
+  })
+  g = pmxgroup([m] * 24)
+  goal = ([10.0] * 24, [50.0] * 24)
+
+  def phys_roundtrip():
+    m.GoalPos.phys = m.GoalPos.phys
+
+  return {
+    'B2Bs(int)': lambda: B2Bs(-5),
+    'B2Bs(tuple16)': lambda: B2Bs(b16),
+    'W2Bs(int)': lambda: W2Bs(-1000),
+    'W2Bs(tuple0)': lambda: W2Bs(()),
+    'W2Bs(tuple1)': lambda: W2Bs((5,)),
+    'W2Bs(tuple120)': lambda: W2Bs(w120),
+    'L2Bs(int)': lambda: L2Bs(-100000),
+    'L2Bs(tuple60)': lambda: L2Bs(l60),
+    'crc16(16B)': lambda: crc(frame16),
+    'crc16(248B)': lambda: crc(frame248),
+    'TxPacket(MemREAD)': lambda: p.TxPacket(0, PMXProtocol.CMD_MemREAD, 0, W2Bs(300) + B2Bs(6)),
+    'RxPacket(MemREAD 6B)': rxpacket,
+    'MemREAD16(3)': lambda: p.MemREAD16(0, 300, 3, signed=True),
+    'MemREAD32(16)': lambda: p.MemREAD32(0, 0, 16),
+    'MotorWRITE(3)': lambda: p.MotorWRITE(0, PMXProtocol.MOTW_OPT_NONE, (100, 200, 300)),
+    'pmx.__getattr__': lambda: m.NowPosition,
+    'pmx.__setattr__': lambda: setattr(m, 'GoalCommandValue1', 100),
+    'pmx.phys(get+set)': phys_roundtrip,
+    'pmxgroup.setphys(24x2)': lambda: g.setphys('GoalPosSpd', goal),
+    'pmxgroup.pack(24x2)': lambda: g.pack('GoalPosSpd'),
+  }
+
+
+def machine():
+  return f'{platform.machine()}-{platform.python_implementation()}{platform.python_version()}'
+
+
+if __name__ == '__main__':
+  import argparse
+  parser = argparse.ArgumentParser(description='microbenchmarks of the CPU-bound protocol paths')
+  parser.add_argument('--save', action='store_true', help='store the result as the baseline of this machine')
+  parser.add_argument('--compare', action='store_true', help='compare with the stored baseline of this machine')
+  parser.add_argument('--threshold', type=float, default=10.0, help='regression threshold in percent')
+  parser.add_argument('-k', dest='filter', default='', help='run only the cases containing this string')
+  args = parser.parse_args()
+
+  os.chdir(os.path.dirname(os.path.abspath(__file__)))
+  baseline = {}
+  if os.path.exists(BASELINE):
+    with open(BASELINE, 'r', encoding='utf-8') as f:
+      baseline = json.load(f)
+  ref = baseline.get(machine(), {})
+
+  result = {}
+  regressed = []
+  print(f'{machine()}')
+  print(f'{"case":24} {"ns/op":>12} {"alloc B/op":>11}' + (f' {"baseline":>12} {"diff":>8}' if args.compare else ''))
+  for name, func in cases().items():
+    if args.filter not in name:
+      continue
+    ns, alloc = measure(func)
+    result[name] = {'ns': ns, 'alloc': alloc}
+    line = f'{name:24} {ns:12.1f} {alloc:11d}'
+    if args.compare and name in ref:
+      diff = (ns - ref[name]['ns']) * 100.0 / ref[name]['ns']
+      line += f' {ref[name]["ns"]:12.1f} {diff:+7.1f}%'
+      if diff > args.threshold:
+        line += ' REGRESSION'
+        regressed.append(name)
+    print(line)
+
+  if args.save:
+    baseline[machine()] = {**ref, **result}
+    with open(BASELINE, 'w', encoding='utf-8') as f:
+      json.dump(baseline, f, indent=2)
+    print(f'saved to {BASELINE}')
+  if args.compare and not ref:
+    print('no baseline for this machine. run with --save first.')
+  if regressed:
+    print(f'{len(regressed)} regression(s): {", ".join(regressed)}')
+    sys.exit(1)
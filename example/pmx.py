@@ -1,12 +1,14 @@
 #!/usr/bin/env python3
 
 from pyPMX import PMXProtocol
-import warnings, struct, json, os
+import warnings, struct, json, os, array, re
 
 
 class pmx:
 
   BaudrateList = {0: 57600, 1: 115200, 2: 625000, 3: 1000000, 4: 1250000, 5: 1500000, 6: 2000000, 7: 3000000}
+  # bumped by updateitems of any instance, so that pmxgroup knows when to check its definitions again
+  _itemsgen = 0
 
   def __del__(self):
     pass
@@ -84,7 +86,7 @@ class pmx:
   @id.setter
   def id(self, newid):
     if newid >= 0 and newid <= 239 and self._id != newid:
-      if self._pmx.MemREAD8(newid, 0) is None:
+      if self._pmx.MemREAD8(newid, 0, cached=False) is None:
         if self._pmx.MotorWRITE(self._id, self._pmx.MOTW_OPT_FREE, ()) is not None:
           baudind = [k for k, v in self.BaudrateList.items() if v == self._pmx.baudrate][0]
           s = (newid, baudind, self._pmx.SYSW_PARITY_NONE, self._sysinfo[3])
@@ -102,7 +104,7 @@ class pmx:
       baudind = [k for k, v in self.BaudrateList.items() if v == newbaud]
       if baudind is not None:
         self._pmx.baudrate = newbaud
-        if self._pmx.MemREAD8(self._id, 0) is None:
+        if self._pmx.MemREAD8(self._id, 0, cached=False) is None:
           self._pmx.baudrate = prevbaud
           if self._pmx.MotorWRITE(self._id, self._pmx.MOTW_OPT_FREE, ()) is not None:
             s = (self._id, baudind[0], self._pmx.SYSW_PARITY_NONE, self._sysinfo[3])
@@ -128,6 +130,13 @@ class pmx:
 
   def updateitems(self, itm):
     self._items.update(itm)
+    pmx._itemsgen += 1
+
+  def subscribe(self, poller, name, rate, callback):
+    if name not in self._items:
+      raise AttributeError(f'No such item: {name}')
+    addr, fmt, _, _, _, _ = self._items[name]
+    return poller.subscribe(self._id, addr, fmt, rate, lambda id, val: callback(self, name, val))
 
   def dump(self):
     for i in self._items:
@@ -267,6 +276,152 @@ class pmx:
       raise AttributeError(f'No such item: {name}')
 
 
+class pmxgroup:
+  # Holds the values of several pmx instances column-wise (one array per item field across the servos),
+  # so that scaling, clipping and packing of joint vectors are done in bulk instead of per servo.
+
+  def __init__(self, members):
+    self._members = tuple(members)
+    self._defs = {}
+    self._values = {}
+    self._valid = {}
+
+  def __len__(self):
+    return len(self._members)
+
+  @property
+  def members(self):
+    return self._members
+
+  @property
+  def ids(self):
+    return tuple(m.id for m in self._members)
+
+  @staticmethod
+  def _fields(fmt):
+    return [c for n, c in re.findall(r'(\d*)([a-zA-Z?])', fmt) for _ in range(int(n) if n else 1) if c != 'x']
+
+  @staticmethod
+  def _percolumn(v, k):
+    if k == 1:
+      return (v,)
+    if isinstance(v, list | tuple):
+      return tuple(v)
+    return (v,) * k
+
+  def _define(self, name):
+    # The range and coefficient are kept per member, since members may be of different models or have their
+    # items changed by updateitems. The definition is rebuilt (and the values dropped) when an item changes.
+    d = self._defs.get(name)
+    if d is not None and d[9] == pmx._itemsgen:
+      return d
+    itms = tuple(m.items.get(name) for m in self._members)
+    if d is not None and all(a is b for a, b in zip(d[8], itms)):
+      d = self._defs[name] = d[:9] + (pmx._itemsgen,)
+      return d
+    if len(itms) == 0 or None in itms:
+      raise AttributeError(f'No such item: {name}')
+    if any(tuple(itm[:2]) != tuple(itms[0][:2]) for itm in itms[1:]):
+      raise AttributeError(f'Item {name} differs between the group members')
+    addr, fmt = itms[0][:2]
+    fields = self._fields(fmt)
+    k = len(fields)
+    access = ''.join(c for c in 'rw' if all(c in itm[2] for itm in itms))
+    v_min = tuple(zip(*(self._percolumn(itm[3][0], k) for itm in itms)))
+    v_max = tuple(zip(*(self._percolumn(itm[3][1], k) for itm in itms)))
+    coefs = tuple(zip(*(tuple(float(c) if isinstance(c, int | float) else 1.0 for c in self._percolumn(itm[5], k)) for itm in itms)))
+    d = (addr, '<' + ''.join(fields), fields, access, v_min, v_max, coefs, struct.calcsize('<' + fmt), itms, pmx._itemsgen)
+    self._defs[name] = d
+    self._values[name] = tuple(array.array(c, bytes(struct.calcsize(c) * len(self._members))) for c in fields)
+    self._valid[name] = [False] * len(self._members)
+    return d
+
+  @staticmethod
+  def _columns(cols):
+    return cols[0] if len(cols) == 1 else cols
+
+  def _clip(self, name, col, v_min, v_max):
+    clipped = [v if lo is None or hi is None else lo if v < lo else hi if v > hi else v for v, lo, hi in zip(col, v_min, v_max)]
+    ids = [m.id for m, v, c in zip(self._members, col, clipped) if v != c]
+    if ids:
+      warnings.warn(f'Out of Range: {name} of ID:{ids} exceeds the range of the member. Clipped {len(ids)} value(s)', UserWarning)
+    return clipped
+
+  def get(self, name):
+    self._define(name)
+    return self._columns(self._values[name])
+
+  def set(self, name, values):
+    _, _, fields, access, v_min, v_max, _, _, _, _ = self._define(name)
+    if 'w' not in access:
+      raise AttributeError(f'{name} is Read-Only')
+    cols = self._percolumn(values, len(fields)) if len(fields) == 1 else tuple(values)
+    if len(cols) != len(fields) or any(len(c) != len(self._members) for c in cols):
+      raise ValueError(f'{name} requires {len(fields)} column(s) of {len(self._members)} value(s)')
+    newcols = []
+    for c, col, _vmin, _vmax in zip(fields, cols, v_min, v_max):
+      col = [int(v) for v in col] if c not in 'efd' else [float(v) for v in col]
+      newcols.append(array.array(c, self._clip(name, col, _vmin, _vmax)))
+    self._values[name] = tuple(newcols)
+    self._valid[name] = [True] * len(self._members)
+    return self._columns(self._values[name])
+
+  def getphys(self, name):
+    coefs = self._define(name)[6]
+    return self._columns(tuple([float(v) * k for v, k in zip(col, kcol)] for col, kcol in zip(self._values[name], coefs)))
+
+  def setphys(self, name, values):
+    _, _, fields, _, _, _, coefs, _, _, _ = self._define(name)
+    cols = self._percolumn(values, len(fields)) if len(fields) == 1 else tuple(values)
+    if len(cols) != len(fields) or any(len(c) != len(self._members) for c in cols):
+      raise ValueError(f'{name} requires {len(fields)} column(s) of {len(self._members)} value(s)')
+    return self.set(name, self._columns(tuple([v / k for v, k in zip(col, kcol)] for col, kcol in zip(cols, coefs))))
+
+  def pack(self, name):
+    fmt = self._define(name)[1]
+    n = len(self._members)
+    cols = self._values[name]
+    flat = cols[0] if len(cols) == 1 else [v for row in zip(*cols) for v in row]
+    return struct.pack(fmt[0] + fmt[1:] * n, *flat)
+
+  def read(self, name):
+    addr, fmt, fields, _, _, _, _, size, _, _ = self._define(name)
+    prev = self.pack(name)
+    valid = self._valid[name]
+    buf = bytearray()
+    for i, m in enumerate(self._members):
+      r = m._pmx.MemREAD(m.id, addr, size)
+      if r is not None and len(r) == size:
+        buf += r
+        valid[i] = True
+      else:
+        warnings.warn(f'Read operation failed. ID:{m.id} {name} keeps the previous value.', UserWarning)
+        buf += prev[i * size:(i + 1) * size]
+    flat = struct.unpack(fmt[0] + fmt[1:] * len(self._members), buf)
+    k = len(fields)
+    self._values[name] = tuple(array.array(c, flat[i::k]) for i, c in enumerate(fields))
+    return self._columns(self._values[name])
+
+  def write(self, name, values=None):
+    if values is not None:
+      self.set(name, values)
+    addr, _, _, access, _, _, _, size, _, _ = self._define(name)
+    if 'w' not in access:
+      raise AttributeError(f'{name} is Read-Only')
+    # never command the zeros the columns start with
+    unset = [m.id for m, v in zip(self._members, self._valid[name]) if not v]
+    if unset:
+      raise ValueError(f'{name} has not been set or read for ID:{unset}')
+    buf = self.pack(name)
+    ret = []
+    for i, m in enumerate(self._members):
+      r = m._pmx.MemWRITE(m.id, addr, buf[i * size:(i + 1) * size])
+      if not r:
+        warnings.warn(f'Write operation failed. ID:{m.id} {name}', UserWarning)
+      ret.append(r)
+    return tuple(ret)
+
+
 if __name__ == '__main__':
   from time import sleep, time
   import traceback, sys, os
@@ -0,0 +1,28 @@
+#!/usr/bin/python3
+import os, sys
+from pyPMX import PMXProtocol, PMXServer
+
+if len(sys.argv) >= 2:
+  dev = sys.argv[1]
+  baud = int(sys.argv[2]) if len(sys.argv) >= 3 else 57600
+  path = sys.argv[3] if len(sys.argv) >= 4 else '/tmp/pmxd.sock'
+else:
+  dev = ''
+
+if not os.path.exists(dev):
+  dev = ''
+
+if dev != '':
+  try:
+    pmx = PMXProtocol(dev, baud)
+  except:
+    print(' ERR:There is some problem.')
+  else:
+    with PMXServer(pmx, path) as server:
+      print(f' serving {dev} ({baud}bps) on {path}')
+      try:
+        server.serve_forever()
+      except KeyboardInterrupt:
+        pass
+else:
+  print(' usage: pmxd <line> [baudrate] [socket path]')
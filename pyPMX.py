@@ -6,34 +6,137 @@
 # SPDX-FileCopyrightText: (C) 2025-2026 mukyokyo
 
 
-import serial, socket, errno, threading, array, time
+import serial, socket, errno, threading, array, time, queue, os, sys, json
 from typing import Union
-from struct import pack, unpack, iter_unpack
+from struct import pack, unpack, iter_unpack, calcsize, pack_into, unpack_from, Struct, error as struct_error
+from multiprocessing import shared_memory
+from collections import deque, namedtuple
 
 
 ##########################################################
 # Functionalized the part of converting int to bytes.
-# If specified as a tuple, it is converted to bytes at once.
+# If specified as a sequence (list, tuple, array.array,
+# memoryview or numpy array), it is converted to bytes at once.
 ##########################################################
+def _isseq(d) -> bool:
+  return isinstance(d, list | tuple | array.array | memoryview | bytes | bytearray) or getattr(d, 'ndim', 0) > 0
+
+
+def _rawseq(d, fmt):
+  # array.array/memoryview already holding integers of the same size can be used as is on little endian hosts
+  if sys.byteorder == 'little':
+    if isinstance(d, array.array):
+      code = d.typecode
+    elif isinstance(d, memoryview):
+      code = d.format.lstrip('@=<')
+    else:
+      return None
+    if code in 'bBhHiIlLqQ' and len(code) == 1 and d.itemsize == calcsize(fmt):
+      return d
+  return None
+
+
+_STRUCTS = {}
+
+
+def _packlist(fmt: str, mask: int, d, buf=None, offset=0):
+  # list/tuple, the usual case (e.g. the goals of MotorWRITE): one Struct per format and length is kept
+  s = _STRUCTS.get((fmt, len(d)))
+  if s is None:
+    s = _STRUCTS[(fmt, len(d))] = Struct(f'<{len(d)}{fmt}')
+  try:
+    if buf is None:
+      return s.pack(*d)
+    s.pack_into(buf, offset, *d)
+    return offset + s.size
+  except struct_error:
+    return _packseq(fmt, mask, d, buf, offset)
+
+
+def _packseq(fmt: str, mask: int, d, buf=None, offset=0):
+  r = _rawseq(d, fmt)
+  if r is not None:
+    if buf is None:
+      return r.tobytes()
+    n = len(r) * r.itemsize
+    buf[offset:offset + n] = r.tobytes() if isinstance(r, array.array) else r.cast('B')
+    return offset + n
+  if hasattr(d, 'astype') and (d.size == 0 or (d.min() >= -(mask >> 1) - 1 and d.max() <= mask)):
+    r = d.astype('<' + {'b': 'i1', 'h': 'i2', 'i': 'i4'}[fmt]).tobytes()
+    if buf is None:
+      return r
+    buf[offset:offset + len(r)] = r
+    return offset + len(r)
+  n = len(d)
+  f = f'<{n}{fmt}'
+  try:
+    r = pack(f, *d) if buf is None else pack_into(f, buf, offset, *d)
+  except struct_error:
+    # values over the signed range are sent as unsigned, negative values with the sign bit set as in the scalar case
+    f = f'<{n}{fmt.upper()}'
+    d = [((v & (mask >> 1)) | (mask ^ (mask >> 1))) if v < 0 else v for v in d]
+    r = pack(f, *d) if buf is None else pack_into(f, buf, offset, *d)
+  return r if buf is None else offset + n * calcsize(fmt)
+
+
 def B2Bs(d) -> bytes:
-  if isinstance(d, list) or isinstance(d, tuple):
-    return bytes(((d & 0x7f) | 0x80) if d < 0 else d for d in d)
+  if isinstance(d, int):
+    return pack('<B', ((d & 0x7f) | 0x80) if d < 0 else d)
+  elif isinstance(d, tuple | list):
+    return _packlist('b', 0xff, d)
+  elif _isseq(d):
+    return _packseq('b', 0xff, d)
   else:
-    return bytes(pack('<B', ((d & 0x7f) | 0x80) if d < 0 else d))
+    return pack('<B', ((d & 0x7f) | 0x80) if d < 0 else d)
 
 
 def W2Bs(d) -> bytes:
-  if isinstance(d, list) or isinstance(d, tuple):
-    return b''.join([pack('<H', d) for d in [((d & 0x7fff) | 0x8000) if d < 0 else d for d in d]])
+  if isinstance(d, int):
+    return pack('<H', ((d & 0x7fff) | 0x8000) if d < 0 else d)
+  elif isinstance(d, tuple | list):
+    return _packlist('h', 0xffff, d)
+  elif _isseq(d):
+    return _packseq('h', 0xffff, d)
   else:
-    return bytes(pack('<H', ((d & 0x7fff) | 0x8000) if d < 0 else d))
+    return pack('<H', ((d & 0x7fff) | 0x8000) if d < 0 else d)
 
 
 def L2Bs(d) -> bytes:
-  if isinstance(d, list) or isinstance(d, tuple):
-    return b''.join([pack('<I', d) for d in [((d & 0x7fffffff) | 0x80000000) if d < 0 else d for d in d]])
+  if isinstance(d, int):
+    return pack('<I', ((d & 0x7fffffff) | 0x80000000) if d < 0 else d)
+  elif isinstance(d, tuple | list):
+    return _packlist('i', 0xffffffff, d)
+  elif _isseq(d):
+    return _packseq('i', 0xffffffff, d)
   else:
-    return bytes(pack('<I', ((d & 0x7fffffff) | 0x80000000) if d < 0 else d))
+    return pack('<I', ((d & 0x7fffffff) | 0x80000000) if d < 0 else d)
+
+
+# Same as above, but written into buf from offset. Returns the offset next to the written data.
+def B2Bs_into(buf, offset: int, d) -> int:
+  if isinstance(d, tuple | list):
+    return _packlist('b', 0xff, d, buf, offset)
+  return _packseq('b', 0xff, d if _isseq(d) else (d,), buf, offset)
+
+
+def W2Bs_into(buf, offset: int, d) -> int:
+  if isinstance(d, tuple | list):
+    return _packlist('h', 0xffff, d, buf, offset)
+  return _packseq('h', 0xffff, d if _isseq(d) else (d,), buf, offset)
+
+
+def L2Bs_into(buf, offset: int, d) -> int:
+  if isinstance(d, tuple | list):
+    return _packlist('i', 0xffffffff, d, buf, offset)
+  return _packseq('i', 0xffffffff, d if _isseq(d) else (d,), buf, offset)
+
+
+# Callbacks run on background threads. An exception is reported on stderr so that the thread goes on.
+def _callback(what: str, func, *args):
+  try:
+    func(*args)
+  except Exception as e:
+    print(f'{what} failed: {type(e).__name__}: {e}', file=sys.stderr)
 
 
 ##########################################################
@@ -57,9 +160,16 @@ class PMXProtocol:
   (SYSW_PARITY_NONE, SYSW_PARITY_ODD, SYSW_PARITY_EVEN) = range(3)
   (MOTW_OPT_NONE, MOTW_OPT_TORQUEON, MOTW_OPT_FREE, _, MOTW_OPT_BRAKE, _, _, _, MOTW_OPT_HOLD) = range(9)
 
+  # In the precise timing mode, waits shorter than this are done by spinning instead of sleeping.
+  PRECISE_SPIN = 0.002
+
+  # Default classification of the memory map for the register cache: (address, length, ttl)
+  # ttl None: static (gain/limit/config tables), > 0: seconds (temperatures), 0: live (not cached)
+  CACHE_PRESET = ((0, 300, None), (310, 4, 1.0))
+
   __crc16_lutable = array.array('H')
 
-  def __init__(self, port: Union[serial.Serial, socket.socket, str], baudrate=57600, timeout=0.01, timeoutoffset=0.05, lock=None, protocoltype=0):
+  def __init__(self, port: Union[serial.Serial, socket.socket, str], baudrate=57600, timeout=0.01, timeoutoffset=0.05, lock=None, protocoltype=0, precise=False):
     if isinstance(port, serial.Serial):
       self.__serial = port
       self.__sock = None
@@ -84,12 +194,37 @@ class PMXProtocol:
         self.__serial.reset_input_buffer()
 
     self.__offsettime = abs(timeoutoffset)
+    self.__precise = precise
 
     if lock is None:
       self.__lock = threading.Lock()
     else:
       self.__lock = lock
     self.__status = 0
+    self.__tracer = None
+    self.__cache = False
+    self.__cacheranges = list(self.CACHE_PRESET)
+    self.__cacheimg = {}
+    self.__cacheexp = {}
+    self.__breaker = 0
+    self.__breakercb = None
+    self.__probeinterval = 0.05
+    self.__maxinterval = 2.0
+    self.__breakerstate = {}
+    self.__down = set()
+    self.__breakerevents = deque()
+    self.__breakerwake = threading.Event()
+    self.__breakerthread = None
+    self.__probing = False
+    self.__coalesce = 0.0
+    self.__feedback = {}
+    self.__txqueue = []
+    self.__txtimer = None
+    self.__txtime = 0
+    self.__txsent = 0
+    self.__txlen = 0
+    self.__rxtimes = None
+    self.__txid = self.__txcmd = None
     poly = 0x1021
     for i in range(256):
       nAccum = i << 8
@@ -101,6 +236,9 @@ class PMXProtocol:
     return self
 
   def __exit__(self, ex_type, ex_value, trace):
+    self.breaker(0)
+    if self.__sock:
+      self.TxFlush()
     if self.__serial is not None:
       self.__serial.close()
 
@@ -133,9 +271,21 @@ class PMXProtocol:
 
   @baudrate.setter
   def baudrate(self, baudrate):
+    # What answered at another baudrate may be a different device.
+    if baudrate != self.__baudrate:
+      self.cacheclear()
     self.__baudrate = baudrate
     self.__serial.baudrate = baudrate
 
+  @property
+  def port(self):
+    if self.__sock:
+      try:
+        return str(self.__sock.getpeername())
+      except OSError:
+        return None
+    return self.__serial.port
+
   @property
   def timeout(self):
     return self.__timeout
@@ -159,6 +309,163 @@ class PMXProtocol:
   def status(self):
     return self.__status
 
+  @property
+  def precise(self):
+    return self.__precise
+
+  @precise.setter
+  def precise(self, precise):
+    self.__precise = precise
+
+  @staticmethod
+  def realtime(cpu=None, priority=None) -> bool:
+    # Pin the calling thread to a CPU and/or run it with SCHED_FIFO (Linux, needs the privilege).
+    try:
+      if cpu is not None:
+        os.sched_setaffinity(0, {cpu})
+      if priority is not None:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+    except (AttributeError, OSError):
+      return False
+    return True
+
+  def __waituntil(self, deadline):
+    remain = deadline - time.perf_counter_ns()
+    if remain > self.PRECISE_SPIN * 1e9:
+      time.sleep(remain / 1e9 - self.PRECISE_SPIN)
+    while time.perf_counter_ns() < deadline:
+      pass
+
+  @property
+  def cache(self):
+    return self.__cache
+
+  @cache.setter
+  def cache(self, enable):
+    self.__cache = enable
+    self.cacheclear()
+
+  def cacherange(self, addr: int, length: int, ttl):
+    # Later definitions take precedence over earlier ones where they overlap.
+    self.__cacheranges.append((addr, length, ttl))
+    self.cacheclear()
+
+  def cacheclear(self, id=None):
+    if id is None:
+      self.__cacheimg.clear()
+      self.__cacheexp.clear()
+    else:
+      self.__cacheinvalidate(id)
+
+  def __cacheget(self, id, addr, length):
+    exp = self.__cacheexp.get(id)
+    if exp is not None and min(exp[addr:addr + length]) > time.monotonic():
+      return bytes(self.__cacheimg[id][addr:addr + length])
+    return None
+
+  def __cacheput(self, id, addr, data):
+    if id not in self.__cacheimg:
+      self.__cacheimg[id] = bytearray(0x500)
+      self.__cacheexp[id] = array.array('d', bytes(8 * 0x500))
+    img, exp = self.__cacheimg[id], self.__cacheexp[id]
+    img[addr:addr + len(data)] = data
+    now = time.monotonic()
+    for a, l, ttl in self.__cacheranges:
+      s, e = max(a, addr), min(a + l, addr + len(data))
+      if s < e:
+        exp[s:e] = array.array('d', (float('inf') if ttl is None else now + ttl if ttl > 0 else 0.0,)) * (e - s)
+
+  def __cacheinvalidate(self, id, addr=0, length=0x500):
+    for _id, exp in self.__cacheexp.items():
+      if id == self.BROADCASTING_ID or id == _id:
+        exp[addr:addr + length] = array.array('d', bytes(8 * len(exp[addr:addr + length])))
+
+  def breaker(self, threshold=3, callback=None, probeinterval=0.05, maxinterval=2.0):
+    # After threshold consecutive failures an ID is marked down and commands to it fail at once,
+    # until a background probe with exponential backoff gets a reply. 0 disables it.
+    self.__breaker = threshold
+    self.__breakercb = callback
+    self.__probeinterval = probeinterval
+    self.__maxinterval = maxinterval
+    if threshold > 0:
+      if self.__breakerthread is None:
+        self.__breakerthread = threading.Thread(target=self.__breakerrun, daemon=True)
+        self.__breakerthread.start()
+    else:
+      self.__down.clear()
+      self.__breakerstate.clear()
+      if self.__breakerthread is not None:
+        self.__breakerwake.set()
+        if self.__breakerthread is not threading.current_thread():
+          self.__breakerthread.join()
+        self.__breakerthread = None
+
+  @property
+  def down(self) -> tuple:
+    return tuple(sorted(self.__down))
+
+  # The arguments of the last breaker(), so that it can be suspended with breaker(0) and restored afterwards.
+  @property
+  def breakerconfig(self) -> tuple:
+    return (self.__breaker, self.__breakercb, self.__probeinterval, self.__maxinterval)
+
+  def __breakerok(self, id):
+    st = self.__breakerstate.get(id)
+    if st is not None:
+      st[0] = 0
+      if id in self.__down:
+        self.__down.discard(id)
+        st[2] = self.__probeinterval
+        self.__breakerevents.append((id, True))
+        self.__breakerwake.set()
+
+  def __breakerfail(self, id):
+    st = self.__breakerstate.setdefault(id, [0, 0.0, self.__probeinterval])
+    st[0] += 1
+    if st[0] >= self.__breaker and id not in self.__down:
+      st[1] = time.monotonic() + st[2]
+      self.__down.add(id)
+      self.__breakerevents.append((id, False))
+      self.__breakerwake.set()
+
+  def __probe(self, id) -> bool:
+    with self.__lock:
+      self.__probing = True
+      try:
+        if self.TxPacket(id, self.CMD_MemREAD, 0, W2Bs(0) + B2Bs(1))[1]:
+          return self.RxPacket()[1]
+        return False
+      finally:
+        self.__probing = False
+
+  def __breakerrun(self):
+    while self.__breaker > 0:
+      # Cleared before the work, so a wake-up set meanwhile (events, breaker(0)) is not lost.
+      self.__breakerwake.clear()
+      while self.__breakerevents:
+        id, up = self.__breakerevents.popleft()
+        cb = self.__breakercb
+        if cb is not None:
+          _callback(f'breaker callback for id:{id}', cb, id, up)
+      now = time.monotonic()
+      for id in tuple(self.__down):
+        st = self.__breakerstate.get(id)
+        if st is not None and st[1] <= now and not self.__probe(id):
+          st[2] = min(st[2] * 2, self.__maxinterval)
+          st[1] = time.monotonic() + st[2]
+      if self.__breaker > 0 and not self.__breakerevents:
+        nextprobe = min((st[1] for st in (self.__breakerstate.get(id) for id in tuple(self.__down)) if st is not None), default=None)
+        wait = self.__maxinterval if nextprobe is None else nextprobe - time.monotonic()
+        self.__breakerwake.wait(min(max(wait, 0), self.__maxinterval))
+
+  @property
+  def tracer(self):
+    return self.__tracer
+
+  @tracer.setter
+  def tracer(self, tracer):
+    self.__tracer = tracer
+
   def __crc16(self, data: bytes) -> int:
     crc = 0
     for d in data:
@@ -184,36 +491,133 @@ class PMXProtocol:
   def __calctransmittime(self, length):
     return 10 * length / self.__baudrate
 
+  def transmittime(self, length: int) -> float:
+    return self.__calctransmittime(length)
+
+  # perf_counter_ns of the start of the request, the first byte and the completion of the last reply,
+  # and the lengths of the request and the reply. Any thread on the bus overwrites it; use times=True of
+  # MemREAD or feedback() to get the times of a particular reply.
+  @property
+  def rxtimes(self) -> tuple:
+    return self.__rxtimes
+
   def TxPacket(self, id: int, cmd: int, opt: int, param: bytes, echo=False, wait=-1.0) -> (bytes, bool):
+    if self.__breaker and id in self.__down and not self.__probing:
+      self.__status = 0
+      return None, False
     self.__reconfig()
-    if ((id >= 0 and id <= 239) or id == self.BROADCASTING_ID) and len(param) <= (256 - 8):
-      txp = bytes([0xfe, 0xfe, id, len(param) + 8, cmd, opt]) + bytes(param)
-      txp += W2Bs(self.__crc16(txp))
+    txp = self.BuildPacket(id, cmd, opt, param)
+    if txp is not None:
       if echo:
         print('TX:', txp.hex(':'))
+      t0 = time.perf_counter_ns()
+      txlen = len(txp)
       if self.__sock:
-        self.__clear_sock_rx_buf()
-        try:
-          if self.__protocoltype == 2:
-            self.__sock.sendall(txp.replace(b'a', b'a\0'))
-          else:
-            self.__sock.sendall(txp)
-        except socket.timeout:
+        if self.__coalesce > 0 and id == self.BROADCASTING_ID and wait < 0:
+          # no reply is expected, so it can wait for the frames that follow. It is timed and traced when sent.
+          self.__txqueue.append(txp)
+          if self.__txtimer is None:
+            self.__txtimer = threading.Timer(self.__coalesce, self.TxFlush)
+            self.__txtimer.daemon = True
+            self.__txtimer.start()
+          return txp, True
+        # queued frames go first in the same send, so the request ends that much later
+        txlen += sum(len(f) for f in self.__txqueue)
+        if not self.__sock_send(txp):
           return None, False
+        t0 = self.__txsent
       else:
         self.__serial.reset_input_buffer()
         self.__serial.write(txp)
+      self.__txid, self.__txcmd, self.__txtime, self.__txlen = id, cmd, t0, txlen
+      if self.__tracer is not None:
+        self.__tracer.record(t0, 'TX', id, cmd, None, txp, 0)
       if wait >= 0:
         if not self.__sock:
           self.__serial.flush()
         t = self.__calctransmittime(len(txp))
-        if wait > t:
+        if self.__precise:
+          # the wait counts from the start of the transmission, and never ends before the last byte has left
+          self.__waituntil(t0 + int(max(wait, t) * 1e9))
+        elif wait > t:
           time.sleep(wait - t)
         else:
           time.sleep(t)
       return txp, True
     return None, False
 
+  def BuildPacket(self, id: int, cmd: int, opt: int, param: bytes) -> bytes:
+    if ((id >= 0 and id <= 239) or id == self.BROADCASTING_ID) and len(param) <= (255 - 8):
+      txp = bytes([0xfe, 0xfe, id, len(param) + 8, cmd, opt]) + bytes(param)
+      return txp + W2Bs(self.__crc16(txp))
+    return None
+
+  def __sock_send(self, txp=b'') -> bool:
+    # queued frames go out in the same send as txp
+    if self.__txtimer is not None:
+      self.__txtimer.cancel()
+      self.__txtimer = None
+    queued = tuple(self.__txqueue)
+    if queued:
+      txp = b''.join(queued) + txp
+      self.__txqueue.clear()
+    if not txp:
+      return True
+    self.__clear_sock_rx_buf()
+    self.__txsent = time.perf_counter_ns()
+    try:
+      if self.__protocoltype == 2:
+        self.__sock.sendall(txp.replace(b'a', b'a\0'))
+      else:
+        self.__sock.sendall(txp)
+    except socket.timeout:
+      return False
+    if self.__tracer is not None:
+      for f in queued:
+        self.__tracer.record(self.__txsent, 'TX', f[2], f[4], None, f, 0)
+    return True
+
+  def TxPackets(self, frames, echo=False) -> bool:
+    # Sends frames made by BuildPacket at once. Only the last one may expect a reply.
+    frames = tuple(frames)
+    if any(f is None for f in frames):
+      return False
+    txp = b''.join(frames)
+    if echo:
+      print('TX:', txp.hex(':'))
+    t0 = time.perf_counter_ns()
+    txlen = len(txp)
+    if self.__sock:
+      txlen += sum(len(f) for f in self.__txqueue)
+      if not self.__sock_send(txp):
+        return False
+      t0 = self.__txsent
+    else:
+      self.__serial.reset_input_buffer()
+      self.__serial.write(txp)
+    if frames:
+      self.__txid, self.__txcmd, self.__txtime, self.__txlen = frames[-1][2], frames[-1][4], t0, txlen
+      if self.__tracer is not None:
+        for f in frames:
+          self.__tracer.record(t0, 'TX', f[2], f[4], None, f, 0)
+    return True
+
+  def TxFlush(self) -> bool:
+    with self.__lock:
+      if self.__sock:
+        return self.__sock_send()
+      return True
+
+  @property
+  def coalesce(self):
+    return self.__coalesce
+
+  @coalesce.setter
+  def coalesce(self, window):
+    self.__coalesce = window
+    if window <= 0:
+      self.TxFlush()
+
   def __rx_sock(self, length) -> bytes:
     try:
       s = self.__sock.recv(length)
@@ -221,8 +625,8 @@ class PMXProtocol:
     except TimeoutError:
       return b''
 
-  def __rx(self, length) -> bytes:
-    tout = time.time() + self.__calctransmittime(length) + self.__offsettime
+  def __rx(self, length, offset=None) -> bytes:
+    tout = time.time() + self.__calctransmittime(length) + (self.__offsettime if offset is None else offset)
     s = self.__rx_sock(length) if self.__sock else self.__serial.read(length)
     rxl = len(s)
     if rxl == length:
@@ -248,15 +652,24 @@ class PMXProtocol:
         self.__serial.timeout = timeout
         self.__serial.flushOutput()
     self.__status = 0
-    rxp = self.__rx(6)
+    # a given timeout also bounds the wait for the rest of the frame
+    offset = min(timeout, self.__offsettime) if timeout > 0 else None
+    rxp = self.__rx(6, offset)
+    t1 = time.perf_counter_ns()
     if rxp:
       if len(rxp) == 6:
         if rxp[3] > 0:
           pl = rxp[3] - 6
           if pl > 0:
-            rxp += self.__rx(pl)
+            rxp += self.__rx(pl, offset)
             if len(rxp) == pl + 6 and rxp[0] == 0xfe and rxp[1] == 0xfe and unpack('<H', rxp[-2:])[0] == self.__crc16(rxp[:-2]):
               self.__status = rxp[5]
+              t = time.perf_counter_ns()
+              self.__rxtimes = (self.__txtime, t1 - int(self.__calctransmittime(5) * 1e9), t, self.__txlen, len(rxp))
+              if self.__breaker:
+                self.__breakerok(rxp[2])
+              if self.__tracer is not None:
+                self.__tracer.record(t, 'RX', rxp[2], rxp[4] | 0x80, rxp[5], rxp, t - self.__txtime)
               if echo:
                 print('RX:', rxp.hex(':'))
               if timeout > 0:
@@ -265,6 +678,11 @@ class PMXProtocol:
                 else:
                   self.__serial.timeout = prev_timeout
               return bytes(rxp), True
+    if self.__breaker and self.__txid is not None and self.__txid != self.BROADCASTING_ID:
+      self.__breakerfail(self.__txid)
+    if self.__tracer is not None:
+      t = time.perf_counter_ns()
+      self.__tracer.record(t, 'RX', self.__txid, self.__txcmd, None, rxp, t - self.__txtime)
     if echo:
       print('RX;', rxp.hex(';'), ' xxx')
     if timeout > 0:
@@ -274,17 +692,22 @@ class PMXProtocol:
         self.__serial.timeout = prev_timeout
     return None, False
 
+  def __memwrite(self, id: int, addr: int, data: bytes, echo=False) -> bool:
+    if ((id >= 0 and id <= 239) or id == self.BROADCASTING_ID) and addr >= 0 and addr <= 0x4ff:
+      if self.__cacheexp:
+        self.__cacheinvalidate(id, addr, len(data))
+      if self.TxPacket(id, self.CMD_MemWRITE, 1, W2Bs(addr) + data, echo)[1]:
+        if id != self.BROADCASTING_ID:
+          d, r = self.RxPacket(echo)
+          if r:
+            return (d[2] == id) and (d[4] == 0x21)
+        else:
+          return True
+    return False
+
   def MemWRITE(self, id: int, addr: int, data: bytes, echo=False) -> bool:
     with self.__lock:
-      if ((id >= 0 and id <= 239) or id == self.BROADCASTING_ID) and addr >= 0 and addr <= 0x4ff:
-        if self.TxPacket(id, self.CMD_MemWRITE, 1, W2Bs(addr) + data, echo)[1]:
-          if id != self.BROADCASTING_ID:
-            d, r = self.RxPacket(echo)
-            if r:
-              return (d[2] == id) and (d[4] == 0x21)
-          else:
-            return True
-      return False
+      return self.__memwrite(id, addr, data, echo)
 
   def MemWRITE8(self, id: int, addr: int, data: Union[int, list, tuple], echo=False) -> bool:
     return self.MemWRITE(id, addr, B2Bs(data), echo)
@@ -295,39 +718,93 @@ class PMXProtocol:
   def MemWRITE32(self, id: int, addr: int, data: Union[int, list, tuple], echo=False) -> bool:
     return self.MemWRITE(id, addr, L2Bs(data), echo)
 
-  def MemREAD(self, id: int, addr: int, length: int, echo=False) -> bytes:
+  def __memread(self, id: int, addr: int, length: int, echo=False, cached=True) -> bytes:
+    if addr >= 0 and id <= 239 and addr >= 0 and addr <= 0x4ff and length > 0 and length > 0 and length <= 247:
+      if self.__cache and cached:
+        d = self.__cacheget(id, addr, length)
+        if d is not None:
+          return d
+      if self.TxPacket(id, self.CMD_MemREAD, 0, W2Bs(addr) + B2Bs(length), echo)[1]:
+        d, r = self.RxPacket(echo)
+        if r:
+          if d[4] == 0x20 and id == d[2] and (d[5] & (4 + 8 + 0x10 + 0x40)) == 0:
+            if self.__cache:
+              self.__cacheput(id, addr, d[6:-2])
+            return bytes(d[6:-2])
+        elif self.__cacheexp:
+          # no answer, so the device may have been replaced or reconfigured
+          self.__cacheinvalidate(id)
+    return None
+
+  # cached=False always asks the device, e.g. to check whether it is present.
+  # times=True returns (data, rxtimes) of this reply, with None for the times when answered from the cache.
+  def MemREAD(self, id: int, addr: int, length: int, echo=False, cached=True, times=False) -> bytes:
     with self.__lock:
-      if addr >= 0 and id <= 239 and addr >= 0 and addr <= 0x4ff and length > 0 and length > 0 and length <= 247:
-        if self.TxPacket(id, self.CMD_MemREAD, 0, W2Bs(addr) + B2Bs(length), echo)[1]:
-          d, r = self.RxPacket(echo)
-          if r:
-            if d[4] == 0x20 and id == d[2] and (d[5] & (4 + 8 + 0x10 + 0x40)) == 0:
-              return bytes(d[6:-2])
+      if not times:
+        return self.__memread(id, addr, length, echo, cached)
+      prev = self.__rxtimes
+      d = self.__memread(id, addr, length, echo, cached)
+      return None if d is None else (d, None if self.__rxtimes is prev else self.__rxtimes)
+
+  # Ranges of any length within the memory map are split into the largest frames and
+  # transferred back to back while holding the bus. Only the failed chunks are retried.
+  def MemREAD_range(self, id: int, addr: int, length: int, retry=2, echo=False) -> bytes:
+    if id < 0 or id > 239 or addr < 0 or length <= 0 or addr + length > 0x500:
       return None
+    buf = bytearray(length)
+    with self.__lock:
+      for ofs in range(0, length, 247):
+        n = min(247, length - ofs)
+        for _ in range(retry + 1):
+          d = self.__memread(id, addr + ofs, n, echo)
+          if d is not None and len(d) == n:
+            buf[ofs:ofs + n] = d
+            break
+        else:
+          return None
+    return bytes(buf)
+
+  def MemWRITE_range(self, id: int, addr: int, data: bytes, retry=2, echo=False) -> bool:
+    if not ((id >= 0 and id <= 239) or id == self.BROADCASTING_ID) or addr < 0 or addr + len(data) > 0x500:
+      return False
+    data = memoryview(bytes(data))
+    with self.__lock:
+      for ofs in range(0, len(data), 245):
+        for _ in range(retry + 1):
+          if self.__memwrite(id, addr + ofs, data[ofs:ofs + 245].tobytes(), echo):
+            break
+        else:
+          return False
+    return True
 
-  def MemREAD8(self, id: int, addr: int, length=1, signed=False, echo=False) -> int:
-    r = self.MemREAD(id, addr, length, echo)
+  def MemREAD8(self, id: int, addr: int, length=1, signed=False, echo=False, cached=True, times=False) -> int:
+    r = self.MemREAD(id, addr, length, echo, cached, times)
     if r is not None:
-      n = sum(iter_unpack('b' if signed else 'B', r), ())
-      return n if length > 1 else n[0]
+      n = sum(iter_unpack('b' if signed else 'B', r[0] if times else r), ())
+      n = n if length > 1 else n[0]
+      return (n, r[1]) if times else n
     return None
 
-  def MemREAD16(self, id: int, addr: int, length=1, signed=False, echo=False) -> int:
-    r = self.MemREAD(id, addr, 2 * length, echo)
+  def MemREAD16(self, id: int, addr: int, length=1, signed=False, echo=False, cached=True, times=False) -> int:
+    r = self.MemREAD(id, addr, 2 * length, echo, cached, times)
     if r is not None:
-      n = sum(iter_unpack('h' if signed else 'H', r), ())
-      return n if length > 1 else n[0]
+      n = sum(iter_unpack('h' if signed else 'H', r[0] if times else r), ())
+      n = n if length > 1 else n[0]
+      return (n, r[1]) if times else n
     return None
 
-  def MemREAD32(self, id: int, addr: int, length=1, signed=False, echo=False) -> int:
-    r = self.MemREAD(id, addr, 4 * length, echo)
+  def MemREAD32(self, id: int, addr: int, length=1, signed=False, echo=False, cached=True, times=False) -> int:
+    r = self.MemREAD(id, addr, 4 * length, echo, cached, times)
     if r is not None:
-      n = sum(iter_unpack('i' if signed else 'I', r), ())
-      return n if length > 1 else n[0]
+      n = sum(iter_unpack('i' if signed else 'I', r[0] if times else r), ())
+      n = n if length > 1 else n[0]
+      return (n, r[1]) if times else n
     return None
 
   def LOAD(self, id: int, echo=False) -> bool:
     with self.__lock:
+      if self.__cacheexp:
+        self.__cacheinvalidate(id)
       if self.TxPacket(id, self.CMD_LOAD, 0, (), echo)[1]:
         if id != self.BROADCASTING_ID:
           d, r = self.RxPacket(echo)
@@ -348,12 +825,32 @@ class PMXProtocol:
           return True
       return False
 
-  def MotorREAD(self, id: int, echo=False) -> tuple:
+  # The latest reply of MotorREAD/MotorWRITE per ID, kept with its time of reception.
+  # times=True adds the rxtimes of that reply.
+  def feedback(self, id: int, maxage=None, times=False) -> tuple:
+    f = self.__feedback.get(id)
+    if f is not None:
+      age = time.monotonic() - f[0]
+      if maxage is None or age <= maxage:
+        return (f[2], f[1], age, f[3]) if times else (f[2], f[1], age)
+    return None
+
+  def __storefeedback(self, id, dat, reply):
+    if dat[2] == id and dat[4] == reply and len(dat) > 9:
+      r = tuple([dat[6], tuple(n[0] for n in iter_unpack('<h', dat[7:-2]))])
+      self.__feedback[id] = (time.monotonic(), dat[5], r, self.__rxtimes)
+
+  def MotorREAD(self, id: int, echo=False, maxage=None) -> tuple:
+    if maxage is not None:
+      f = self.feedback(id, maxage)
+      if f is not None:
+        return f[0]
     with self.__lock:
-      if self.TxPacket(id, self.CMD_MotorREAD, 0, (), echo):
+      if self.TxPacket(id, self.CMD_MotorREAD, 0, (), echo)[1]:
         if id != self.BROADCASTING_ID:
           dat, r = self.RxPacket(echo)
           if r:
+            self.__storefeedback(id, dat, 0x24)
             return tuple([dat[6], tuple(n[0] for n in iter_unpack('<h', dat[7:-2])) if len(dat[7:-2]) > 0 and dat[4] == 0x24 else ()])
           else:
             return None
@@ -363,10 +860,11 @@ class PMXProtocol:
 
   def MotorWRITE(self, id: int, opt: int, dat: (), echo=False) -> tuple:
     with self.__lock:
-      if self.TxPacket(id, self.CMD_MotorWRITE, opt, W2Bs(dat), echo):
+      if self.TxPacket(id, self.CMD_MotorWRITE, opt, W2Bs(dat), echo)[1]:
         if id != self.BROADCASTING_ID:
           dat, r = self.RxPacket(echo)
           if r:
+            self.__storefeedback(id, dat, 0x25)
             return tuple([dat[6], tuple(n[0] for n in iter_unpack('<h', dat[7:-2])) if len(dat[7:-2]) > 0 and dat[4] == 0x25 else ()])
           else:
             return None
@@ -389,6 +887,9 @@ class PMXProtocol:
       d = self.SystemREAD(id, echo)
       if d:
         with self.__lock:
+          if self.__cacheexp:
+            self.__cacheinvalidate(id)
+            self.__cacheinvalidate(data[0])
           if self.TxPacket(id, self.CMD_SystemWRITE, 0xf, L2Bs(d[0]) + B2Bs(data), echo)[1]:
             d, r = self.RxPacket(echo)
             if r:
@@ -397,6 +898,8 @@ class PMXProtocol:
 
   def ReBoot(self, id: int, echo=False) -> bool:
     with self.__lock:
+      if self.__cacheexp:
+        self.__cacheinvalidate(id)
       if id != self.BROADCASTING_ID:
         if self.TxPacket(id, self.CMD_ReBoot, 0, W2Bs(0), echo)[1]:
           d, r = self.RxPacket(echo)
@@ -409,6 +912,8 @@ class PMXProtocol:
       d = self.SystemREAD(id, echo)
       if d is not None:
         with self.__lock:
+          if self.__cacheexp:
+            self.__cacheinvalidate(id)
           if self.TxPacket(id, self.CMD_FactoryReset, 0, L2Bs(d[0]), echo)[1]:
             d, r = self.RxPacket(echo)
             if r:
@@ -418,15 +923,922 @@ class PMXProtocol:
   def FullScan(self) -> tuple:
     orgtimeout = self.timeout
     orgbaudrate = self.baudrate
+    orgbreaker = self.breakerconfig
     baud = (57600, 115200, 625000, 1000000, 1250000, 1500000, 2000000, 3000000)
     self.timeout = 0.005
+    self.breaker(0)
     for b in baud:
       self.baudrate = b
       for id in range(240):
-        r = self.MemREAD8(id, 0)
+        r = self.MemREAD8(id, 0, cached=False)
         print(f'baud:{b:7} id:{id:3} :', end='find\n' if r else 'none\r')
     self.timeout = orgtimeout
     self.baudrate = orgbaudrate
+    self.breaker(*orgbreaker)
+
+
+##########################################################
+# Packet tracing.
+# Events are appended to a bounded ring buffer inside the
+# transaction and handed to the sink by a background thread.
+##########################################################
+PMXTraceEvent = namedtuple('PMXTraceEvent', ('time_ns', 'direction', 'id', 'cmd', 'status', 'length', 'latency_ns', 'raw'))
+
+
+class PMXTracer:
+
+  def __init__(self, sink=None, size=4096, ids=None, cmds=None, interval=0.05):
+    self.__sink = self.print_sink if sink is None else sink
+    self.__ring = deque(maxlen=size)
+    self.__ids = None if ids is None else frozenset(ids)
+    self.__cmds = None if cmds is None else frozenset(cmds)
+    self.__interval = interval
+    self.__dropped = 0
+    self.__stop = threading.Event()
+    self.__thread = None
+
+  def __enter__(self):
+    self.start()
+    return self
+
+  def __exit__(self, ex_type, ex_value, trace):
+    self.stop()
+
+  @property
+  def dropped(self):
+    return self.__dropped
+
+  @staticmethod
+  def print_sink(ev):
+    status = '--' if ev.status is None else f'{ev.status:02x}'
+    cmd = '--' if ev.cmd is None else f'{ev.cmd:02x}'
+    print(f'{ev.time_ns / 1e9:.6f} {ev.direction} id:{ev.id} cmd:{cmd} stat:{status} len:{ev.length} lat:{ev.latency_ns / 1e3:.0f}us', ev.raw.hex(':'))
+
+  def record(self, time_ns, direction, id, cmd, status, raw, latency_ns):
+    if (self.__ids is None or id in self.__ids) and (self.__cmds is None or cmd in self.__cmds):
+      if len(self.__ring) == self.__ring.maxlen:
+        self.__dropped += 1
+      self.__ring.append((time_ns, direction, id, cmd, status, len(raw), latency_ns, bytes(raw)))
+
+  def drain(self) -> int:
+    n = 0
+    while True:
+      try:
+        ev = self.__ring.popleft()
+      except IndexError:
+        return n
+      _callback('trace sink', self.__sink, PMXTraceEvent._make(ev))
+      n += 1
+
+  def __run(self):
+    while not self.__stop.wait(self.__interval):
+      self.drain()
+    self.drain()
+
+  def start(self):
+    if self.__thread is None:
+      self.__stop.clear()
+      self.__thread = threading.Thread(target=self.__run, daemon=True)
+      self.__thread.start()
+
+  def stop(self):
+    if self.__thread is not None:
+      self.__stop.set()
+      self.__thread.join()
+      self.__thread = None
+
+
+##########################################################
+# Multi-rate polling of subscribed memory items.
+# Due subscriptions are merged into contiguous MemREADs per ID.
+##########################################################
+class PMXPoller:
+  def __init__(self, pmx: PMXProtocol, maxgap=8, echo=False):
+    self.__pmx = pmx
+    self.__maxgap = maxgap
+    self.__echo = echo
+    self.__subs = {}
+    self.__handle = 0
+    self.__lock = threading.Lock()
+    self.__thread = None
+    self.__stop = threading.Event()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, ex_type, ex_value, trace):
+    self.stop()
+
+  def subscribe(self, id: int, addr: int, fmt: str, rate: float, callback) -> int:
+    size = calcsize('<' + fmt)
+    if id < 0 or id > 239 or addr < 0 or addr + size > 0x500 or size <= 0 or size > 247 or rate <= 0:
+      raise ValueError('invalid subscription')
+    with self.__lock:
+      self.__handle += 1
+      self.__subs[self.__handle] = [id, addr, size, '<' + fmt, 1.0 / rate, callback, time.monotonic()]
+      return self.__handle
+
+  def unsubscribe(self, handle: int) -> bool:
+    with self.__lock:
+      return self.__subs.pop(handle, None) is not None
+
+  def __merge(self, subs):
+    ranges = []
+    for s in sorted(subs, key=lambda s: (s[0], s[1])):
+      if ranges:
+        id, start, end, members = ranges[-1]
+        if id == s[0] and s[1] <= end + self.__maxgap and max(end, s[1] + s[2]) - start <= 247:
+          ranges[-1][2] = max(end, s[1] + s[2])
+          members.append(s)
+          continue
+      ranges.append([s[0], s[1], s[1] + s[2], [s]])
+    return ranges
+
+  def tick(self, now=None) -> float:
+    if now is None:
+      now = time.monotonic()
+    with self.__lock:
+      due = [s for s in self.__subs.values() if s[6] <= now]
+      for s in due:
+        s[6] += s[4]
+        if s[6] <= now:
+          s[6] = now + s[4]
+    for id, start, end, members in self.__merge(due):
+      r = self.__pmx.MemREAD(id, start, end - start, self.__echo)
+      for _, addr, size, fmt, _, callback, _ in members:
+        if r is not None:
+          v = unpack(fmt, r[addr - start:addr - start + size])
+          _callback(f'poller callback for id:{id}', callback, id, v[0] if len(v) == 1 else v)
+        else:
+          _callback(f'poller callback for id:{id}', callback, id, None)
+    with self.__lock:
+      return min((s[6] for s in self.__subs.values()), default=now + 0.01)
+
+  def __run(self):
+    while not self.__stop.is_set():
+      t = self.tick() - time.monotonic()
+      if t > 0:
+        self.__stop.wait(t)
+
+  def start(self):
+    if self.__thread is None:
+      self.__stop.clear()
+      self.__thread = threading.Thread(target=self.__run, daemon=True)
+      self.__thread.start()
+
+  def stop(self):
+    if self.__thread is not None:
+      self.__stop.set()
+      self.__thread.join()
+      self.__thread = None
+
+
+##########################################################
+# Publication of the latest servo state through shared memory.
+# Each slot is guarded by its own sequence counter (seqlock),
+# the header holds a generation counter bumped on every update.
+##########################################################
+class PMXStatePublisher:
+  MAGIC = b'PMXS'
+  VERSION = 1
+  MAXVALUES = 12
+  HEADER = Struct('<4sHHI4x')
+  SLOTHEAD = Struct('<IBBBxd')
+  SLOT = Struct('<IBBBxd12i')
+
+  def __init__(self, ids, name=None):
+    self.__ids = tuple(ids)
+    self.__slot = {id: n for n, id in enumerate(self.__ids)}
+    self.__shm = shared_memory.SharedMemory(name=name, create=True, size=self.HEADER.size + self.SLOT.size * len(self.__ids))
+    self.__gen = 0
+    self.HEADER.pack_into(self.__shm.buf, 0, self.MAGIC, self.VERSION, len(self.__ids), 0)
+    for n, id in enumerate(self.__ids):
+      self.SLOT.pack_into(self.__shm.buf, self.HEADER.size + n * self.SLOT.size, 0, id, 0, 0, 0.0, *((0,) * self.MAXVALUES))
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, ex_type, ex_value, trace):
+    self.close()
+    self.unlink()
+
+  @property
+  def name(self):
+    return self.__shm.name
+
+  @property
+  def ids(self):
+    return self.__ids
+
+  def publish(self, id: int, values, status=0, timestamp=None):
+    values = tuple(values)[:self.MAXVALUES]
+    ofs = self.HEADER.size + self.__slot[id] * self.SLOT.size
+    buf = self.__shm.buf
+    seq = unpack_from('<I', buf, ofs)[0]
+    pack_into('<I', buf, ofs, (seq + 1) & 0xffffffff)
+    self.SLOT.pack_into(buf, ofs, (seq + 1) & 0xffffffff, id, status & 0xff, len(values), time.monotonic() if timestamp is None else timestamp, *(values + (0,) * (self.MAXVALUES - len(values))))
+    pack_into('<I', buf, ofs, (seq + 2) & 0xffffffff)
+    self.__gen = (self.__gen + 1) & 0xffffffff
+    pack_into('<I', buf, 8, self.__gen)
+
+  def publish_motor(self, id: int, r: tuple, timestamp=None) -> bool:
+    if r:
+      self.publish(id, r[1], r[0], timestamp)
+      return True
+    return False
+
+  def publish_mem(self, id: int, data: bytes, fmt='hhhhhhhhhHHH', status=0, timestamp=None) -> bool:
+    if data is not None:
+      self.publish(id, unpack('<' + fmt, data), status, timestamp)
+      return True
+    return False
+
+  def update(self, pmx: PMXProtocol, addr=300, fmt='hhhhhhhhhHHH'):
+    for id in self.__ids:
+      self.publish_mem(id, pmx.MemREAD(id, addr, calcsize('<' + fmt)), fmt, pmx.status)
+
+  def close(self):
+    self.__shm.close()
+
+  def unlink(self):
+    self.__shm.unlink()
+
+
+class PMXStateReader:
+
+  def __init__(self, name: str, retry=100):
+    # The publisher owns the block; keep the tracker from removing it when this process ends.
+    try:
+      self.__shm = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+      # Before Python 3.13, attaching registers the block. Undo it only when the tracker was started for this
+      # attach, since a tracker inherited from the publisher (e.g. a multiprocessing child) holds its registration.
+      # _resource_tracker._fd is private to CPython 3.8-3.12 (checked on 3.11); without it the tracker is taken as
+      # our own, since leaving the registration would remove the block while the publisher still uses it.
+      from multiprocessing import resource_tracker
+      owntracker = getattr(getattr(resource_tracker, '_resource_tracker', None), '_fd', None) is None
+      self.__shm = shared_memory.SharedMemory(name=name)
+      if owntracker:
+        resource_tracker.unregister(self.__shm._name, 'shared_memory')
+    magic, version, n, _ = PMXStatePublisher.HEADER.unpack_from(self.__shm.buf, 0)
+    if magic != PMXStatePublisher.MAGIC or version != PMXStatePublisher.VERSION:
+      self.__shm.close()
+      raise ValueError(f'{name} is not a PMX state block')
+    self.__retry = retry
+    self.__slot = {}
+    for i in range(n):
+      ofs = PMXStatePublisher.HEADER.size + i * PMXStatePublisher.SLOT.size
+      self.__slot[PMXStatePublisher.SLOTHEAD.unpack_from(self.__shm.buf, ofs)[1]] = ofs
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, ex_type, ex_value, trace):
+    self.close()
+
+  @property
+  def ids(self):
+    return tuple(self.__slot)
+
+  @property
+  def generation(self) -> int:
+    return unpack_from('<I', self.__shm.buf, 8)[0]
+
+  def read(self, id: int) -> tuple:
+    ofs = self.__slot[id]
+    buf = self.__shm.buf
+    for _ in range(self.__retry):
+      seq = unpack_from('<I', buf, ofs)[0]
+      if seq & 1:
+        continue
+      v = PMXStatePublisher.SLOT.unpack_from(buf, ofs)
+      if unpack_from('<I', buf, ofs)[0] == seq:
+        if seq == 0:
+          return None
+        return v[4], v[2], v[5:5 + v[3]]
+    return None
+
+  def readall(self) -> dict:
+    return {id: self.read(id) for id in self.__slot}
+
+  def close(self):
+    self.__shm.close()
+
+
+##########################################################
+# Bus server for sharing one PMXProtocol between processes.
+# Requests from the clients are queued by priority and executed
+# by a single bus thread; a batch is executed back to back.
+##########################################################
+def _rpc_pack(v) -> bytes:
+  if v is None:
+    return b'N'
+  elif v is True:
+    return b'T'
+  elif v is False:
+    return b'F'
+  elif isinstance(v, int):
+    return b'i' + pack('<q', v)
+  elif isinstance(v, float):
+    return b'd' + pack('<d', v)
+  elif isinstance(v, str):
+    v = v.encode()
+    return b's' + pack('<I', len(v)) + v
+  elif isinstance(v, bytes | bytearray | memoryview):
+    return b'b' + pack('<I', len(v)) + bytes(v)
+  elif isinstance(v, list | tuple):
+    return b't' + pack('<H', len(v)) + b''.join(_rpc_pack(d) for d in v)
+  raise TypeError(f'{type(v).__name__} can not be transferred')
+
+
+def _rpc_unpack(buf: bytes, ofs=0) -> (object, int):
+  t = buf[ofs]
+  ofs += 1
+  if t == 0x4e:
+    return None, ofs
+  elif t == 0x54:
+    return True, ofs
+  elif t == 0x46:
+    return False, ofs
+  elif t == 0x69:
+    return unpack_from('<q', buf, ofs)[0], ofs + 8
+  elif t == 0x64:
+    return unpack_from('<d', buf, ofs)[0], ofs + 8
+  elif t == 0x73 or t == 0x62:
+    n = unpack_from('<I', buf, ofs)[0]
+    v = bytes(buf[ofs + 4:ofs + 4 + n])
+    return v.decode() if t == 0x73 else v, ofs + 4 + n
+  elif t == 0x74:
+    n = unpack_from('<H', buf, ofs)[0]
+    ofs += 2
+    v = []
+    for i in range(n):
+      d, ofs = _rpc_unpack(buf, ofs)
+      v.append(d)
+    return tuple(v), ofs
+  raise ValueError(f'unknown tag {t:#x}')
+
+
+def _rpc_recv(sock) -> bytes:
+  h = b''
+  while len(h) < 4:
+    r = sock.recv(4 - len(h))
+    if not r:
+      return None
+    h += r
+  n = unpack('<I', h)[0]
+  buf = bytearray()
+  while len(buf) < n:
+    r = sock.recv(n - len(buf))
+    if not r:
+      return None
+    buf += r
+  return bytes(buf)
+
+
+def _rpc_send(sock, payload: bytes):
+  sock.sendall(pack('<I', len(payload)) + payload)
+
+
+class PMXServer:
+  (RPC_HELLO, RPC_CALL, RPC_BATCH, RPC_ERROR) = range(4)
+  METHODS = ('MemREAD', 'MemREAD8', 'MemREAD16', 'MemREAD32', 'MemWRITE', 'MemWRITE8', 'MemWRITE16', 'MemWRITE32', 'LOAD', 'SAVE', 'MotorREAD', 'MotorWRITE', 'SystemREAD', 'SystemWRITE', 'ReBoot', 'FactoryReset', 'feedback', 'MemREAD_range', 'MemWRITE_range')
+
+  def __init__(self, pmx: PMXProtocol, path: str):
+    self.__pmx = pmx
+    self.__path = path
+    self.__queue = queue.PriorityQueue()
+    self.__order = 0
+    self.__orderlock = threading.Lock()
+    self.__running = threading.Event()
+    self.__sock = None
+    self.__clients = set()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, ex_type, ex_value, trace):
+    self.shutdown()
+
+  @property
+  def path(self):
+    return self.__path
+
+  def __call(self, name, args):
+    r = getattr(self.__pmx, self.METHODS[name])(*args)
+    return (r, self.__pmx.status)
+
+  def __worker(self):
+    while True:
+      _, _, item = self.__queue.get()
+      if item is None:
+        break
+      conn, seq, kind, req = item
+      try:
+        if kind == self.RPC_CALL:
+          ret = self.__call(*req)
+        else:
+          ret = tuple(self.__call(*r) for r in req)
+        payload = pack('<HB', seq, kind) + _rpc_pack(ret)
+      except Exception as e:
+        payload = pack('<HB', seq, self.RPC_ERROR) + _rpc_pack(f'{type(e).__name__}: {e}')
+      try:
+        _rpc_send(conn, payload)
+      except OSError:
+        pass
+
+  def __client(self, conn):
+    priority = 0
+    try:
+      while self.__running.is_set():
+        buf = _rpc_recv(conn)
+        if buf is None:
+          break
+        try:
+          seq, kind = unpack_from('<HB', buf)
+          req = _rpc_unpack(buf, 3)[0]
+        except (ValueError, IndexError, UnicodeDecodeError, struct_error):
+          break
+        if kind == self.RPC_HELLO:
+          # The priority is compared with the others in the queue, so anything but an int would break the worker.
+          if type(req) is not int:
+            _rpc_send(conn, pack('<HB', seq, self.RPC_ERROR) + _rpc_pack(f'TypeError: priority must be int, not {type(req).__name__}'))
+            break
+          priority = req
+          _rpc_send(conn, pack('<HB', seq, kind) + _rpc_pack(self.METHODS))
+        elif kind == self.RPC_CALL or kind == self.RPC_BATCH:
+          with self.__orderlock:
+            self.__order += 1
+            order = self.__order
+          self.__queue.put((priority, order, (conn, seq, kind, req)))
+    except OSError:
+      pass
+    finally:
+      self.__clients.discard(conn)
+      conn.close()
+
+  def serve_forever(self):
+    if os.path.exists(self.__path):
+      os.unlink(self.__path)
+    self.__sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.__sock.bind(self.__path)
+    self.__sock.listen()
+    self.__running.set()
+    worker = threading.Thread(target=self.__worker, daemon=True)
+    worker.start()
+    try:
+      while self.__running.is_set():
+        try:
+          conn, _ = self.__sock.accept()
+        except OSError:
+          break
+        self.__clients.add(conn)
+        threading.Thread(target=self.__client, args=(conn,), daemon=True).start()
+    finally:
+      self.__queue.put((-1 << 31, 0, None))
+      worker.join()
+      if os.path.exists(self.__path):
+        os.unlink(self.__path)
+
+  def shutdown(self):
+    self.__running.clear()
+    if self.__sock is not None:
+      try:
+        self.__sock.shutdown(socket.SHUT_RDWR)
+      except OSError:
+        pass
+      self.__sock.close()
+    for conn in list(self.__clients):
+      try:
+        conn.shutdown(socket.SHUT_RDWR)
+      except OSError:
+        pass
+
+
+class PMXClient:
+  BROADCASTING_ID = PMXProtocol.BROADCASTING_ID
+  (SYSW_BAUD_57600, SYSW_BAUD_115_2k, SYSW_BAUD_625k, SYSW_BAUD_1M, SYSW_BAUD_1_25M, SYSW_BAUD_1_5M, SYSW_BAUD_2M, SYSW_BAUD_3M) = range(8)
+  (SYSW_PARITY_NONE, SYSW_PARITY_ODD, SYSW_PARITY_EVEN) = range(3)
+  (MOTW_OPT_NONE, MOTW_OPT_TORQUEON, MOTW_OPT_FREE, _, MOTW_OPT_BRAKE, _, _, _, MOTW_OPT_HOLD) = range(9)
+
+  class RemoteError(Exception):
+    pass
+
+  def __init__(self, path: str, priority=0, lock=None):
+    self.__sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.__sock.connect(path)
+    self.__lock = threading.Lock() if lock is None else lock
+    self.__seq = 0
+    self.__status = 0
+    self.__methods = {n: i for i, n in enumerate(self.__request(PMXServer.RPC_HELLO, priority))}
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, ex_type, ex_value, trace):
+    self.close()
+
+  def close(self):
+    self.__sock.close()
+
+  @property
+  def lock(self):
+    return self.__lock
+
+  @property
+  def status(self):
+    return self.__status
+
+  def __request(self, kind, req):
+    with self.__lock:
+      self.__seq = (self.__seq + 1) & 0xffff
+      _rpc_send(self.__sock, pack('<HB', self.__seq, kind) + _rpc_pack(req))
+      buf = _rpc_recv(self.__sock)
+    if buf is None:
+      raise ConnectionError('bus server closed the connection')
+    seq, rkind = unpack_from('<HB', buf)
+    ret = _rpc_unpack(buf, 3)[0]
+    if rkind == PMXServer.RPC_ERROR:
+      raise self.RemoteError(ret)
+    return ret
+
+  def __call(self, name, *args):
+    r, self.__status = self.__request(PMXServer.RPC_CALL, (self.__methods[name], args))
+    return r
+
+  def Batch(self, calls) -> tuple:
+    ret = self.__request(PMXServer.RPC_BATCH, tuple((self.__methods[n], tuple(a)) for n, a in calls))
+    if ret:
+      self.__status = ret[-1][1]
+    return tuple(r for r, _ in ret)
+
+  def MemWRITE(self, id: int, addr: int, data: bytes, echo=False) -> bool:
+    return self.__call('MemWRITE', id, addr, bytes(data))
+
+  def MemWRITE8(self, id: int, addr: int, data: Union[int, list, tuple], echo=False) -> bool:
+    return self.__call('MemWRITE8', id, addr, data)
+
+  def MemWRITE16(self, id: int, addr: int, data: Union[int, list, tuple], echo=False) -> bool:
+    return self.__call('MemWRITE16', id, addr, data)
+
+  def MemWRITE32(self, id: int, addr: int, data: Union[int, list, tuple], echo=False) -> bool:
+    return self.__call('MemWRITE32', id, addr, data)
+
+  def MemREAD(self, id: int, addr: int, length: int, echo=False, cached=True, times=False) -> bytes:
+    return self.__call('MemREAD', id, addr, length, False, cached, times)
+
+  def MemREAD_range(self, id: int, addr: int, length: int, retry=2, echo=False) -> bytes:
+    return self.__call('MemREAD_range', id, addr, length, retry)
+
+  def MemWRITE_range(self, id: int, addr: int, data: bytes, retry=2, echo=False) -> bool:
+    return self.__call('MemWRITE_range', id, addr, bytes(data), retry)
+
+  def MemREAD8(self, id: int, addr: int, length=1, signed=False, echo=False, cached=True, times=False) -> int:
+    return self.__call('MemREAD8', id, addr, length, signed, False, cached, times)
+
+  def MemREAD16(self, id: int, addr: int, length=1, signed=False, echo=False, cached=True, times=False) -> int:
+    return self.__call('MemREAD16', id, addr, length, signed, False, cached, times)
+
+  def MemREAD32(self, id: int, addr: int, length=1, signed=False, echo=False, cached=True, times=False) -> int:
+    return self.__call('MemREAD32', id, addr, length, signed, False, cached, times)
+
+  def LOAD(self, id: int, echo=False) -> bool:
+    return self.__call('LOAD', id)
+
+  def SAVE(self, id: int, echo=False) -> bool:
+    return self.__call('SAVE', id)
+
+  def MotorREAD(self, id: int, echo=False, maxage=None) -> tuple:
+    return self.__call('MotorREAD', id, False, maxage)
+
+  def MotorWRITE(self, id: int, opt: int, dat: (), echo=False) -> tuple:
+    return self.__call('MotorWRITE', id, opt, dat)
+
+  def SystemREAD(self, id: int, echo=False) -> tuple:
+    return self.__call('SystemREAD', id)
+
+  def SystemWRITE(self, id: int, data: (), echo=False) -> bool:
+    return self.__call('SystemWRITE', id, data)
+
+  def ReBoot(self, id: int, echo=False) -> bool:
+    return self.__call('ReBoot', id)
+
+  def FactoryReset(self, id: int, echo=False) -> bool:
+    return self.__call('FactoryReset', id)
+
+  def feedback(self, id: int, maxage=None, times=False) -> tuple:
+    return self.__call('feedback', id, maxage, times)
+
+
+##########################################################
+# Health monitoring of error status and temperatures.
+# Reads are issued only inside idle slots granted by the
+# control loop, so monitoring does not eat into its cycle.
+##########################################################
+class PMXHealthMonitor:
+  ITEMS = (('error', 400, '<BBBxH'), ('temp', 310, '<hhH'))
+
+  def __init__(self, pmx: PMXProtocol, ids, callback=None, templimit=None, lostcount=3, retryinterval=1.0, pingtimeout=0.002):
+    self.__pmx = pmx
+    self.__ids = tuple(ids)
+    self.__callback = callback
+    self.__templimit = templimit
+    self.__lostcount = lostcount
+    self.__retryinterval = retryinterval
+    self.__pingtimeout = pingtimeout
+    self.__tasks = [(id, n) for id in self.__ids for n in range(len(self.ITEMS))]
+    self.__next = 0
+    self.__cost = [0.002] * len(self.__tasks)
+    self.__pingcost = [pingtimeout] * len(self.__tasks)
+    self.__retry = {id: 0.0 for id in self.__ids}
+    self.__deadline = 0.0
+    self.__lock = threading.Lock()
+    self.__wake = threading.Event()
+    self.__stop = threading.Event()
+    self.__thread = None
+    self.__health = {id: {'state': 'unknown', 'error': None, 'motortemp': None, 'cputemp': None, 'voltage': None, 'hot': False, 'fails': 0, 'time': None} for id in self.__ids}
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, ex_type, ex_value, trace):
+    self.stop()
+
+  @property
+  def health(self) -> dict:
+    with self.__lock:
+      return {id: dict(h) for id, h in self.__health.items()}
+
+  def __event(self, id, event, h):
+    if self.__callback is not None:
+      _callback(f'health callback for id:{id}', self.__callback, id, event, dict(h))
+
+  def __update(self, id, item, r):
+    events = []
+    with self.__lock:
+      h = self.__health[id]
+      if r is None:
+        h['fails'] += 1
+        if h['fails'] >= self.__lostcount and h['state'] != 'lost':
+          h['state'] = 'lost'
+          events.append('lost')
+      else:
+        if h['state'] == 'lost':
+          h['state'] = 'unknown'
+          events.append('found')
+        h['fails'] = 0
+        h['time'] = time.monotonic()
+        name, _, fmt = self.ITEMS[item]
+        if name == 'error':
+          v = unpack(fmt, r)
+          h['error'] = v
+          if v[0] != 0 and h['state'] != 'error':
+            h['state'] = 'error'
+            events.append('error')
+          elif v[0] == 0 and h['state'] != 'ok':
+            if h['state'] == 'error':
+              events.append('clear')
+            h['state'] = 'ok'
+        else:
+          h['motortemp'], h['cputemp'], h['voltage'] = unpack(fmt, r)
+          if self.__templimit is not None:
+            hot = max(h['motortemp'], h['cputemp']) > self.__templimit
+            if hot != h['hot']:
+              h['hot'] = hot
+              events.append('hot' if hot else 'cool')
+      h = dict(h)
+    for e in events:
+      self.__event(id, e, h)
+
+  def __ping(self, id) -> bool:
+    with self.__pmx.lock:
+      if self.__pmx.TxPacket(id, PMXProtocol.CMD_MemREAD, 0, W2Bs(0) + B2Bs(1))[1]:
+        return self.__pmx.RxPacket(timeout=self.__pingtimeout)[1]
+      return False
+
+  def step(self) -> float:
+    i = self.__next
+    self.__next = (i + 1) % len(self.__tasks)
+    id, item = self.__tasks[i]
+    _, addr, fmt = self.ITEMS[item]
+    failing = self.__suspect(id)[0]
+    t = time.perf_counter()
+    # An ID that has failed is pinged with pingtimeout first, so that it does not wait the full timeout again.
+    if failing and not self.__ping(id):
+      r = None
+      self.__pingcost[i] = time.perf_counter() - t
+    else:
+      r = self.__pmx.MemREAD(id, addr, calcsize(fmt))
+    t = time.perf_counter() - t
+    if r is None:
+      self.__retry[id] = time.monotonic() + self.__retryinterval
+    elif not failing:
+      self.__cost[i] += (t - self.__cost[i]) * 0.2
+    self.__update(id, item, r)
+    return t
+
+  def __suspect(self, id) -> (bool, bool):
+    # (failed since the last reply, lost)
+    with self.__lock:
+      h = self.__health[id]
+      return h['fails'] > 0, h['state'] == 'lost'
+
+  def idle(self, budget: float):
+    with self.__lock:
+      self.__deadline = time.perf_counter() + budget
+    self.__wake.set()
+
+  def __run(self):
+    while not self.__stop.is_set():
+      self.__wake.wait()
+      self.__wake.clear()
+      skipped = 0
+      while not self.__stop.is_set() and skipped < len(self.__tasks):
+        with self.__lock:
+          deadline = self.__deadline
+        i = self.__next
+        id = self.__tasks[i][0]
+        failing, lost = self.__suspect(id)
+        fits = time.perf_counter() + (self.__pingcost[i] if failing else self.__cost[i]) <= deadline
+        # IDs that failed are skipped while the slot cannot take a ping, and lost ones until their retry is due.
+        if (failing and not fits) or (lost and time.monotonic() < self.__retry[id]):
+          self.__next = (i + 1) % len(self.__tasks)
+          skipped += 1
+          continue
+        if not fits:
+          break
+        skipped = 0
+        self.step()
+
+  def start(self):
+    if self.__thread is None:
+      self.__stop.clear()
+      self.__thread = threading.Thread(target=self.__run, daemon=True)
+      self.__thread.start()
+
+  def stop(self):
+    if self.__thread is not None:
+      self.__stop.set()
+      self.__wake.set()
+      self.__thread.join()
+      self.__thread = None
+
+
+##########################################################
+# Bus topology persisted to a file.
+# Known IDs are checked once at their recorded baudrate, and
+# only the ones that do not answer are searched for again.
+##########################################################
+class PMXTopology:
+  BAUDRATES = (57600, 115200, 625000, 1000000, 1250000, 1500000, 2000000, 3000000)
+
+  def __init__(self, path: str, pingtimeout=0.005):
+    self.__path = path
+    self.__pingtimeout = pingtimeout
+    self.__topology = {}
+    self.load()
+
+  def load(self) -> bool:
+    try:
+      with open(self.__path, 'r', encoding='utf-8') as f:
+        self.__topology = json.load(f)
+      return True
+    except (OSError, ValueError):
+      self.__topology = {}
+      return False
+
+  def save(self):
+    tmp = self.__path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+      json.dump(self.__topology, f, indent=2)
+    os.replace(tmp, self.__path)
+
+  def devices(self, port) -> dict:
+    return {int(id): v for id, v in self.__topology.get(str(port), {}).items()}
+
+  def __record(self, port, id, baudrate, sysinfo):
+    self.__topology.setdefault(str(port), {})[str(id)] = {'baudrate': baudrate, 'model': sysinfo[1], 'firmware': sysinfo[2]}
+
+  def __sweep(self, pmx: PMXProtocol, ids, bauds) -> dict:
+    found = {}
+    for b in bauds:
+      pmx.baudrate = b
+      for id in ids:
+        if id not in found and pmx.MemREAD8(id, 0, cached=False) is not None:
+          sysinfo = pmx.SystemREAD(id)
+          if sysinfo is not None:
+            found[id] = (b, sysinfo)
+    return found
+
+  # Silence at the wrong baudrates is expected, so the breaker is suspended while searching.
+  def discover(self, pmx: PMXProtocol, ids=range(240), bauds=None) -> dict:
+    orgtimeout, orgbaudrate, orgbreaker = pmx.timeout, pmx.baudrate, pmx.breakerconfig
+    pmx.timeout = self.__pingtimeout
+    pmx.breaker(0)
+    try:
+      found = self.__sweep(pmx, tuple(ids), self.BAUDRATES if bauds is None else bauds)
+    finally:
+      pmx.timeout, pmx.baudrate = orgtimeout, orgbaudrate
+      pmx.breaker(*orgbreaker)
+    self.__topology[str(pmx.port)] = {}
+    for id, (b, sysinfo) in found.items():
+      self.__record(pmx.port, id, b, sysinfo)
+    self.save()
+    return self.devices(pmx.port)
+
+  def connect(self, pmx: PMXProtocol) -> dict:
+    known = self.devices(pmx.port)
+    if not known:
+      return self.discover(pmx)
+    orgtimeout, orgbaudrate, orgbreaker = pmx.timeout, pmx.baudrate, pmx.breakerconfig
+    pmx.timeout = self.__pingtimeout
+    pmx.breaker(0)
+    lost = []
+    try:
+      for b in sorted(set(v['baudrate'] for v in known.values())):
+        pmx.baudrate = b
+        for id, v in known.items():
+          if v['baudrate'] == b:
+            sysinfo = pmx.SystemREAD(id)
+            if sysinfo is None or sysinfo[1] != v['model']:
+              lost.append(id)
+            elif sysinfo[2] != v['firmware']:
+              self.__record(pmx.port, id, b, sysinfo)
+      found = self.__sweep(pmx, lost, self.BAUDRATES) if lost else {}
+    finally:
+      pmx.timeout, pmx.baudrate = orgtimeout, orgbaudrate
+      pmx.breaker(*orgbreaker)
+    for id in lost:
+      if id in found:
+        self.__record(pmx.port, id, *found[id])
+      else:
+        del self.__topology[str(pmx.port)][str(id)]
+    self.save()
+    return self.devices(pmx.port)
+
+
+##########################################################
+# Latency-compensated state estimation.
+# The moment each servo sampled its present values is inferred
+# from the reply timestamps and the wire time, and the values
+# of all servos are extrapolated to a common time.
+##########################################################
+class PMXEstimator:
+
+  def __init__(self, pmx: PMXProtocol, alpha=0.5, horizon=0.05):
+    # alpha: position of the sampling between the end of the request and the start of the reply
+    # horizon: longest extrapolation in seconds
+    self.__pmx = pmx
+    self.__alpha = alpha
+    self.__horizon = int(horizon * 1e9)
+    self.__samples = {}
+
+  def sampletime(self, rxtimes) -> int:
+    txstart, _, done, txlen, rxlen = rxtimes
+    reqend = txstart + int(self.__pmx.transmittime(txlen) * 1e9)
+    replystart = done - int(self.__pmx.transmittime(rxlen) * 1e9)
+    if replystart < reqend:
+      replystart = reqend
+    return min(reqend + int((replystart - reqend) * self.__alpha), done)
+
+  # Without values, the latest MotorREAD/MotorWRITE reply of the ID and its times are used.
+  # Values read otherwise need the rxtimes of the same reply, e.g. from MemREAD(..., times=True).
+  def update(self, id: int, values=None, rxtimes=None) -> int:
+    if values is None:
+      f = self.__pmx.feedback(id, times=True)
+      if f is not None:
+        values, rxtimes = f[0][1], f[3]
+    if values is None or rxtimes is None:
+      return None
+    t = self.sampletime(rxtimes)
+    prev = self.__samples.get(id)
+    if prev is not None and prev[0] >= t:
+      return None
+    self.__samples[id] = (t, tuple(values), None if prev is None else prev[:2])
+    return t
+
+  def estimate(self, t=None, ids=None) -> dict:
+    if t is None:
+      t = time.perf_counter_ns()
+    ret = {}
+    for id in (self.__samples if ids is None else ids):
+      s = self.__samples.get(id)
+      if s is None:
+        continue
+      t1, v1, prev = s
+      dt = min(max(t - t1, -self.__horizon), self.__horizon)
+      if prev is not None and len(prev[1]) == len(v1) and t1 > prev[0]:
+        t0, v0 = prev
+        ret[id] = tuple(b + (b - a) * dt / (t1 - t0) for a, b in zip(v0, v1))
+      else:
+        ret[id] = tuple(float(v) for v in v1)
+    return ret
+
+  def clear(self, id=None):
+    if id is None:
+      self.__samples.clear()
+    else:
+      self.__samples.pop(id, None)
 
 
 ##########################################################